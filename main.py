@@ -1,10 +1,18 @@
+import os
 import streamlit as st
 import duckdb
 from huggingface_hub import hf_hub_download
 import pandas as pd
 import tempfile
+import hashlib
+import threading
+import queue
+from contextlib import closing
 from datetime import datetime, timedelta
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
+import xlsxwriter
 import warnings
 
 warnings.filterwarnings('ignore')
@@ -62,90 +70,281 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# ==========================================
+# CONEXÃO DUCKDB
+# ==========================================
+def _available_cpus():
+    """Núcleos que o processo pode usar (afinidade do container), não os do host"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity não existe em macOS/Windows
+        return os.cpu_count() or 1
+
+# Ajustáveis por variável de ambiente conforme a máquina do deploy
+DUCKDB_THREADS = int(os.environ.get('DUCKDB_THREADS', _available_cpus()))
+DUCKDB_MEMORY_LIMIT = os.environ.get('DUCKDB_MEMORY_LIMIT', '700MB')
+EXPORT_BATCH_SIZE = 100_000
+# Maior member_pk numérico (BIGINT); IDs acima disso são ignorados com aviso
+MEMBER_PK_MAX = 2**63 - 1
+# Limite de linhas de uma planilha Excel, descontando o cabeçalho
+EXCEL_MAX_ROWS = 1_048_575
+EXPORT_FORMATS = {
+    "CSV": (".csv", "text/csv"),
+    # CSV compactado pelo próprio DuckDB: arquivo e download várias vezes menores
+    "CSV.gz": (".csv.gz", "application/gzip"),
+    "Excel": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+
+@st.cache_resource(show_spinner=False)
+def _get_database():
+    """Banco DuckDB em memória do processo, configurado uma única vez"""
+    con = duckdb.connect(database=':memory:')
+    # Usa os núcleos liberados ao processo e limita a memória para não estourar o container
+    con.execute(f"PRAGMA threads={DUCKDB_THREADS}")
+    con.execute(f"PRAGMA memory_limit='{DUCKDB_MEMORY_LIMIT}'")
+    # Permite escrita fora de ordem, reduzindo memória em leituras/exportações grandes
+    con.execute("PRAGMA preserve_insertion_order=false")
+    # Mantém metadados do parquet (footer, estatísticas) em cache entre consultas e reruns
+    con.execute("PRAGMA enable_object_cache")
+    try:
+        # Versões recentes do DuckDB trocaram o object cache por este cache de metadados
+        con.execute("SET parquet_metadata_cache=true")
+    except duckdb.Error:
+        pass
+    return con
+
+def dataset_view(caminho):
+    """Nome da view do parquet: um por arquivo, para versões diferentes não se misturarem"""
+    return f"clientes_{hashlib.sha1(caminho.encode()).hexdigest()[:12]}"
+
+def get_connection(caminho=None):
+    """Cursor próprio sobre o banco compartilhado (seguro entre sessões/threads)"""
+    con = _get_database().cursor()
+    if caminho is not None:
+        # Garante a view deste arquivo; consulta o catálogo antes para não reler o footer
+        view = dataset_view(caminho)
+        existe = con.execute(
+            "SELECT 1 FROM duckdb_views() WHERE view_name = $view", {'view': view}
+        ).fetchone()
+        if not existe:
+            caminho_sql = caminho.replace("'", "''")
+            try:
+                con.execute(
+                    f"CREATE VIEW IF NOT EXISTS {view} AS SELECT * FROM read_parquet('{caminho_sql}')"
+                )
+            except duckdb.TransactionException:
+                # Outra sessão criou a mesma view ao mesmo tempo
+                pass
+    return con
+
 # ==========================================
 # FUNÇÕES CACHE
 # ==========================================
-@st.cache_data(show_spinner=False, ttl=3600)
+def _to_timestamp(value, default):
+    """Converte data retornada pelo DuckDB em Timestamp, usando o padrão quando nula"""
+    return pd.Timestamp(value) if value is not None else default
+
+def _column_stats(parquet_file, coluna):
+    """Estatísticas da coluna em cada row group do footer (None onde não houver)"""
+    metadata = parquet_file.metadata
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        column = next((row_group.column(j) for j in range(row_group.num_columns)
+                       if row_group.column(j).path_in_schema == coluna), None)
+        yield row_group, column.statistics if column is not None else None
+
+def _null_count(parquet_file, coluna):
+    """Total de nulos da coluna pelas estatísticas do footer (None se indisponível)"""
+    total = 0
+    for _, stats in _column_stats(parquet_file, coluna):
+        if stats is None or not stats.has_null_count:
+            return None
+        total += stats.null_count
+    return total
+
+def _column_bounds(parquet_file, coluna):
+    """Min/max da coluna pelas estatísticas dos row groups no footer (None se indisponíveis)"""
+    minimo = maximo = None
+    for row_group, stats in _column_stats(parquet_file, coluna):
+        if stats is None:
+            return None
+        if not stats.has_min_max:
+            # Row group inteiramente nulo não contribui para os limites
+            if stats.has_null_count and stats.null_count == row_group.num_rows:
+                continue
+            return None
+        minimo = stats.min if minimo is None else min(minimo, stats.min)
+        maximo = stats.max if maximo is None else max(maximo, stats.max)
+    return minimo, maximo
+
+def _distinct_values(caminho, colunas):
+    """Valores distintos (sem nulos) de cada coluna, lidos dos dicionários dos row groups"""
+    # Colunas de texto chegam como DictionaryArray: basta unir os dicionários,
+    # sem decodificar nem comparar valor a valor
+    parquet_file = pq.ParquetFile(caminho, read_dictionary=colunas)
+    valores = [set() for _ in colunas]
+    for i in range(parquet_file.num_row_groups):
+        tabela = parquet_file.read_row_group(i, columns=colunas)
+        for distintos, coluna in zip(valores, tabela.columns):
+            for chunk in coluna.chunks:
+                if pa.types.is_dictionary(chunk.type):
+                    distintos.update(chunk.dictionary.to_pylist())
+                else:
+                    distintos.update(pc.unique(chunk).to_pylist())
+    for distintos in valores:
+        distintos.discard(None)
+    return valores
+
+@st.cache_data(show_spinner=False)
+def get_dataset_stats(caminho_local, mtime):
+    """Calcula categorias, datas e colunas do parquet; recalcula só quando o arquivo muda (mtime)"""
+    # Contagem via metadados
+    parquet_file = pq.ParquetFile(caminho_local)
+    num_rows = parquet_file.metadata.num_rows
+    
+    # Colunas e tipos pelo schema do footer
+    schema = parquet_file.schema_arrow
+    available_columns = schema.names
+    
+    # Datas min/max pelas estatísticas do footer, sem ler as páginas de dados
+    date_cols = ('data_ultima_visita', 'data_ultima_compra', 'data_cadastro')
+    date_bounds = [_column_bounds(parquet_file, coluna) for coluna in date_cols]
+    
+    # Sem estatísticas no arquivo: lê só as colunas de data que faltaram
+    faltantes = [coluna for coluna, bounds in zip(date_cols, date_bounds)
+                 if bounds is None and coluna in available_columns]
+    if faltantes:
+        tabela = parquet_file.read(columns=faltantes)
+        for coluna in faltantes:
+            min_max = pc.min_max(tabela[coluna])
+            date_bounds[date_cols.index(coluna)] = (min_max['min'].as_py(), min_max['max'].as_py())
+    
+    ((min_visita, max_visita),
+     (min_compra, max_compra),
+     (min_cadastro, max_cadastro)) = [bounds or (None, None) for bounds in date_bounds]
+    
+    # Valores distintos de categoria e setor pelos dicionários dos row groups
+    categorias, setores = _distinct_values(caminho_local, ['categoria', 'setor'])
+    
+    return {
+        'num_rows': num_rows,
+        # Tuplas imutáveis: ordenadas uma vez por arquivo e baratas de hashear nos widgets
+        'categorias': tuple(sorted(categorias)),
+        'setores': tuple(sorted(setores)),
+        'available_columns': available_columns,
+        'min_visita': _to_timestamp(min_visita, pd.Timestamp('2020-01-01')),
+        'max_visita': _to_timestamp(max_visita, pd.Timestamp.now()),
+        'min_compra': _to_timestamp(min_compra, pd.Timestamp('2020-01-01')),
+        'max_compra': _to_timestamp(max_compra, pd.Timestamp.now()),
+        'min_cadastro': _to_timestamp(min_cadastro, pd.Timestamp('2020-01-01')),
+        'max_cadastro': _to_timestamp(max_cadastro, pd.Timestamp.now()),
+        'has_flg_premium': 'flg_premium_ativo' in available_columns,
+        'has_flg_funcionario': 'flg_funcionario' in available_columns,
+        'member_pk_numerico': ('member_pk' in available_columns
+                               and pa.types.is_integer(schema.field('member_pk').type))
+    }
+
+@st.cache_resource(show_spinner=False, ttl=3600)
+def _download_dataset():
+    """Caminho local do parquet no cache do Hugging Face (checado a cada TTL)"""
+    token = st.secrets.get("HF_TOKEN", "")
+    download_args = dict(
+        repo_id="WillianAlencar/SegmentacaoClientes",
+        filename="dataset.parquet",
+        repo_type="dataset",
+        token=token if token else None
+    )
+    # O cache do Hugging Face só baixa de novo se o ETag mudar; a cada TTL
+    # é feita apenas essa checagem. Sem rede, usa a cópia local já baixada
+    try:
+        return hf_hub_download(**download_args)
+    except Exception as erro_download:
+        try:
+            return hf_hub_download(**download_args, local_files_only=True)
+        except Exception:
+            raise erro_download
+
 def get_dataset_info():
     """Obtém informações do dataset de forma eficiente"""
     try:
-        token = st.secrets.get("HF_TOKEN", "")
-        caminho_local = hf_hub_download(
-            repo_id="WillianAlencar/SegmentacaoClientes",
-            filename="dataset.parquet",
-            repo_type="dataset",
-            token=token if token else None
-        )
-        
-        # Contagem via metadados
-        parquet_file = pq.ParquetFile(caminho_local)
-        num_rows = parquet_file.metadata.num_rows
-        
-        # Carrega amostra para análise
-        con = duckdb.connect(database=':memory:')
-        
-        # Amostra para análise
-        sample_query = f"""
-        SELECT DISTINCT categoria, setor
-        FROM read_parquet('{caminho_local}')
-        WHERE categoria IS NOT NULL AND setor IS NOT NULL
-        LIMIT 100
-        """
+        # Falhas não ficam em cache: a próxima interação tenta de novo
+        caminho_local = _download_dataset()
         
-        sample_df = con.execute(sample_query).df()
+        # Varreduras do parquet em cache por versão do arquivo, não pelo TTL
+        mtime = os.path.getmtime(caminho_local)
+        stats = get_dataset_stats(caminho_local, mtime)
         
-        # Informações básicas
-        categorias = sample_df['categoria'].dropna().unique().tolist()
-        setores = sample_df['setor'].dropna().unique().tolist()
-        
-        # Datas min/max para todos os campos de data
-        dates_query = f"""
-        SELECT 
-            MIN(data_ultima_visita) as min_visita,
-            MAX(data_ultima_visita) as max_visita,
-            MIN(data_ultima_compra) as min_compra,
-            MAX(data_ultima_compra) as max_compra,
-            MIN(data_cadastro) as min_cadastro,
-            MAX(data_cadastro) as max_cadastro
-        FROM read_parquet('{caminho_local}')
-        """
-        
-        dates_df = con.execute(dates_query).df()
-        
-        # Verifica quais campos existem no dataset
-        try:
-            schema_query = f"DESCRIBE SELECT * FROM read_parquet('{caminho_local}') LIMIT 1"
-            columns_df = con.execute(schema_query).df()
-            available_columns = columns_df['column_name'].values.tolist()
-            has_flg_premium = 'flg_premium_ativo' in available_columns
-            has_flg_funcionario = 'flg_funcionario' in available_columns
-        except:
-            has_flg_premium = False
-            has_flg_funcionario = False
-            available_columns = []
-        
-        con.close()
-        
-        return {
-            'caminho': caminho_local,
-            'num_rows': num_rows,
-            'categorias': sorted(categorias),
-            'setores': sorted(setores),
-            'available_columns': available_columns,
-            'min_visita': dates_df['min_visita'].iloc[0] if not dates_df.empty else pd.Timestamp('2020-01-01'),
-            'max_visita': dates_df['max_visita'].iloc[0] if not dates_df.empty else pd.Timestamp.now(),
-            'min_compra': dates_df['min_compra'].iloc[0] if not dates_df.empty else pd.Timestamp('2020-01-01'),
-            'max_compra': dates_df['max_compra'].iloc[0] if not dates_df.empty else pd.Timestamp.now(),
-            'min_cadastro': dates_df['min_cadastro'].iloc[0] if not dates_df.empty else pd.Timestamp('2020-01-01'),
-            'max_cadastro': dates_df['max_cadastro'].iloc[0] if not dates_df.empty else pd.Timestamp.now(),
-            'has_flg_premium': has_flg_premium,
-            'has_flg_funcionario': has_flg_funcionario
-        }
+        return {'caminho': caminho_local, 'mtime': mtime, **stats}
         
     except Exception as e:
         st.error(f"Erro de conexão: {e}")
         return None
 
+def query_stats(con, view, where_clause, params, has_flg_funcionario, has_flg_premium):
+    """Executa a agregação de totais (registros, únicos, funcionários, premium) para um filtro"""
+    # Agrega direto sobre a view do parquet: só as colunas citadas são lidas;
+    # a contagem exata de únicos roda uma vez por filtro (resultado em cache)
+    stats_query = f"""
+    SELECT 
+        COUNT(*) as total_registros,
+        COUNT(DISTINCT member_pk) as clientes_unicos,
+        {"COUNT(CASE WHEN flg_funcionario = 'S' THEN 1 END) as funcionarios," if has_flg_funcionario else "0 as funcionarios,"}
+        {"COUNT(CASE WHEN flg_premium_ativo = 'S' THEN 1 END) as premium" if has_flg_premium else "0 as premium"}
+    FROM {view}
+    WHERE {where_clause}
+    """
+    result = con.execute(stats_query, params).fetchone()
+    return tuple(result) if result else (0, 0, 0, 0)
+
+@st.cache_data(show_spinner=False)
+def get_base_stats(caminho, mtime, has_flg_funcionario, has_flg_premium):
+    """Totais sem filtros ativos, calculados uma vez por versão do arquivo (mtime)"""
+    # Sem filtros resta só o intervalo completo de visita, que equivale a visita preenchida;
+    # se o footer garante que não há visitas nulas, nem essa coluna precisa ser lida
+    visitas_nulas = _null_count(pq.ParquetFile(caminho), 'data_ultima_visita')
+    where_clause = "TRUE" if visitas_nulas == 0 else "data_ultima_visita IS NOT NULL"
+    
+    con = get_connection(caminho)
+    try:
+        return query_stats(con, dataset_view(caminho), where_clause, {},
+                           has_flg_funcionario, has_flg_premium)
+    finally:
+        con.close()
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def get_filtered_stats(caminho, where_clause, params, has_flg_funcionario, has_flg_premium):
+    """Totais de um filtro, reutilizados entre reruns e sessões com os mesmos filtros"""
+    con = get_connection(caminho)
+    try:
+        return query_stats(con, dataset_view(caminho), where_clause, params,
+                           has_flg_funcionario, has_flg_premium)
+    finally:
+        con.close()
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def get_preview(caminho, cols, where_clause, params):
+    """Obtém as 100 linhas de pré-visualização, reutilizadas entre reruns com os mesmos filtros"""
+    # Datas convertidas no próprio DuckDB (nulas quando inválidas), sem passada em pandas
+    select_cols = [f"TRY_CAST({col} AS TIMESTAMP) AS {col}" if 'data_' in col else col
+                   for col in cols]
+    con = get_connection(caminho)
+    try:
+        preview_query = f"""
+        SELECT {', '.join(select_cols)}
+        FROM {dataset_view(caminho)}
+        WHERE {where_clause}
+        ORDER BY data_ultima_visita DESC
+        LIMIT 100
+        """
+        # Tabela Arrow vai direto ao st.dataframe, sem conversão para pandas
+        preview_df = con.execute(preview_query, params).fetch_arrow_table()
+    finally:
+        con.close()
+    
+    return preview_df
+
 # ==========================================
 # CABEÇALHO
 # ==========================================
@@ -168,67 +367,69 @@ if not dataset_info:
 with st.sidebar:
     st.markdown("### 🔍 Filtros Avançados")
     
-    with st.container():
-        st.markdown('<div class="filter-card">', unsafe_allow_html=True)
-        st.markdown("**Filtros Principais**")
-        
-        # Busca por ID
-        id_busca = st.text_input("Buscar Cliente (ID)", 
-                                 placeholder="Digite o member_pk...")
-        
-        # Categorias
-        cat_sel = st.multiselect("Categorias", 
-                                dataset_info['categorias'],
-                                placeholder="Selecione categorias...")
-        
-        # Setores
-        setor_sel = st.multiselect("Setores", 
-                                  dataset_info['setores'],
-                                  placeholder="Selecione setores...")
-        
-        # Filtro para clientes sem compra
-        apenas_sem_compra = st.checkbox("Apenas clientes sem compra", value=False)
-        
-        # NOVO FILTRO: Funcionários
-        if dataset_info['has_flg_funcionario']:
-            # Opções para filtro de funcionários
-            filtro_funcionarios = st.radio(
-                "Filtro de Funcionários:",
-                ["Todos", "Apenas funcionários", "Excluir funcionários"],
-                index=0,
-                key="filtro_funcionarios"
-            )
-        else:
-            filtro_funcionarios = "Todos"
-            st.caption("ℹ️ Campo 'flg_funcionario' não disponível no dataset")
+    # Formulário: alterações nos filtros só disparam as consultas ao clicar em "Aplicar"
+    with st.form("filtros"):
+        with st.container():
+            st.markdown('<div class="filter-card">', unsafe_allow_html=True)
+            st.markdown("**Filtros Principais**")
+        
+            # Busca por ID
+            id_busca = st.text_input("Buscar Cliente (ID)", 
+                                     placeholder="Digite o member_pk...")
+        
+            # Categorias
+            cat_sel = st.multiselect("Categorias", 
+                                    dataset_info['categorias'],
+                                    placeholder="Selecione categorias...")
+        
+            # Setores
+            setor_sel = st.multiselect("Setores", 
+                                      dataset_info['setores'],
+                                      placeholder="Selecione setores...")
+        
+            # Filtro para clientes sem compra
+            apenas_sem_compra = st.checkbox("Apenas clientes sem compra", value=False)
+        
+            # NOVO FILTRO: Funcionários
+            if dataset_info['has_flg_funcionario']:
+                # Opções para filtro de funcionários
+                filtro_funcionarios = st.radio(
+                    "Filtro de Funcionários:",
+                    ["Todos", "Apenas funcionários", "Excluir funcionários"],
+                    index=0,
+                    key="filtro_funcionarios"
+                )
+            else:
+                filtro_funcionarios = "Todos"
+                st.caption("ℹ️ Campo 'flg_funcionario' não disponível no dataset")
         
-        # FILTRO: Usuários premium ativos
-        if dataset_info['has_flg_premium']:
-            # Nova opção: filtrar apenas premium ativos
-            apenas_premium = st.checkbox("Apenas usuários premium ativos", value=False)
+            # FILTRO: Usuários premium ativos
+            if dataset_info['has_flg_premium']:
+                # Nova opção: filtrar apenas premium ativos
+                apenas_premium = st.checkbox("Apenas usuários premium ativos", value=False)
             
-            # Mantém a opção antiga para compatibilidade
-            excluir_premium = st.checkbox("Excluir clientes premium", value=False)
+                # Mantém a opção antiga para compatibilidade
+                excluir_premium = st.checkbox("Excluir clientes premium", value=False)
             
-            # Validação de filtros contraditórios
-            if apenas_premium and excluir_premium:
-                st.warning("⚠️ Selecione apenas uma opção de filtro premium")
-        else:
-            apenas_premium = False
-            excluir_premium = False
-            st.caption("ℹ️ Campo 'flg_premium_ativo' não disponível no dataset")
+                # Validação de filtros contraditórios
+                if apenas_premium and excluir_premium:
+                    st.warning("⚠️ Selecione apenas uma opção de filtro premium")
+            else:
+                apenas_premium = False
+                excluir_premium = False
+                st.caption("ℹ️ Campo 'flg_premium_ativo' não disponível no dataset")
             
-        st.markdown('</div>', unsafe_allow_html=True)
+            st.markdown('</div>', unsafe_allow_html=True)
     
-    with st.container():
-        st.markdown('<div class="filter-card">', unsafe_allow_html=True)
-        st.markdown("**Filtros de Data**")
+        with st.container():
+            st.markdown('<div class="filter-card">', unsafe_allow_html=True)
+            st.markdown("**Filtros de Data**")
         
-        # Data de Cadastro
-        st.markdown("**Data de Cadastro**")
-        usar_cadastro = st.toggle("Ativar filtro de cadastro", value=False, key="toggle_cadastro")
+            # Data de Cadastro
+            st.markdown("**Data de Cadastro**")
+            usar_cadastro = st.toggle("Ativar filtro de cadastro", value=False, key="toggle_cadastro")
         
-        if usar_cadastro:
+            # Datas sempre visíveis: dentro do formulário o toggle só vale após aplicar
             col_cad1, col_cad2 = st.columns(2)
             with col_cad1:
                 data_inicio_cadastro = st.date_input("De", 
@@ -240,29 +441,25 @@ with st.sidebar:
                                                  value=dataset_info['max_cadastro'].date(),
                                                  key="fim_cadastro",
                                                  label_visibility="collapsed")
-        else:
-            data_inicio_cadastro = None
-            data_fim_cadastro = None
         
-        # Data de Visita
-        st.markdown("**Última Visita**")
-        col1, col2 = st.columns(2)
-        with col1:
-            data_inicio_visita = st.date_input("De", 
-                                              value=dataset_info['min_visita'].date(),
-                                              key="inicio_visita",
-                                              label_visibility="collapsed")
-        with col2:
-            data_fim_visita = st.date_input("Até", 
-                                           value=dataset_info['max_visita'].date(),
-                                           key="fim_visita",
-                                           label_visibility="collapsed")
+            # Data de Visita
+            st.markdown("**Última Visita**")
+            col1, col2 = st.columns(2)
+            with col1:
+                data_inicio_visita = st.date_input("De", 
+                                                  value=dataset_info['min_visita'].date(),
+                                                  key="inicio_visita",
+                                                  label_visibility="collapsed")
+            with col2:
+                data_fim_visita = st.date_input("Até", 
+                                               value=dataset_info['max_visita'].date(),
+                                               key="fim_visita",
+                                               label_visibility="collapsed")
         
-        # Data de Compra
-        st.markdown("**Última Compra**")
-        usar_compra = st.toggle("Ativar filtro", value=False, key="toggle_compra")
+            # Data de Compra
+            st.markdown("**Última Compra**")
+            usar_compra = st.toggle("Ativar filtro", value=False, key="toggle_compra")
         
-        if usar_compra:
             col3, col4 = st.columns(2)
             with col3:
                 data_inicio_compra = st.date_input("De", 
@@ -274,11 +471,10 @@ with st.sidebar:
                                                value=dataset_info['max_compra'].date(),
                                                key="fim_compra",
                                                label_visibility="collapsed")
-        else:
-            data_inicio_compra = None
-            data_fim_compra = None
             
-        st.markdown('</div>', unsafe_allow_html=True)
+            st.markdown('</div>', unsafe_allow_html=True)
+    
+        st.form_submit_button("✅ Aplicar filtros", type="primary", use_container_width=True)
     
     with st.container():
         st.markdown('<div class="filter-card">', unsafe_allow_html=True)
@@ -286,39 +482,59 @@ with st.sidebar:
         
         only_member_pk = st.checkbox("Exportar apenas IDs", value=False)
         export_format = st.radio("Formato:", 
-                                ["CSV", "Excel"], 
+                                list(EXPORT_FORMATS), 
                                 horizontal=True)
         st.markdown('</div>', unsafe_allow_html=True)
 
 # ==========================================
 # FUNÇÕES DE PROCESSAMENTO
 # ==========================================
+def _in_condition(coluna, nome, valores, params):
+    """Monta `coluna = $v` (um valor) ou `coluna IN ($v0, ...)`, ligando cada valor em params"""
+    # Comparações com constantes viram filtros do scan do parquet e usam as
+    # estatísticas min/max dos row groups; list_contains é avaliado linha a linha
+    nomes = [f"{nome}_{i}" for i in range(len(valores))]
+    params.update(zip(nomes, valores))
+    if len(nomes) == 1:
+        return f"{coluna} = ${nomes[0]}"
+    return f"{coluna} IN ({', '.join('$' + n for n in nomes)})"
+
 def build_query_conditions():
-    """Constrói condições WHERE para a query SQL com validação"""
+    """Constrói condições WHERE para a query SQL com validação e parâmetros"""
     conditions = []
+    params = {}
     
     # Validação de filtros contraditórios
     filter_warnings = []
     
     # Filtro por ID específico
     if id_busca and id_busca.strip():
-        conditions.append(f"member_pk = '{id_busca}'")
+        id_valor = id_busca.strip()
+        if not dataset_info['member_pk_numerico']:
+            conditions.append("member_pk = $id_busca")
+            params['id_busca'] = id_valor
+        elif id_valor.isascii() and id_valor.isdigit() and int(id_valor) <= MEMBER_PK_MAX:
+            # Só dígitos ASCII (isdigit() sozinho aceita '²', que o int() rejeita)
+            # e dentro do BIGINT: valores maiores não podem ser ligados ao parâmetro
+            conditions.append("member_pk = $id_busca")
+            params['id_busca'] = int(id_valor)
+        else:
+            # member_pk numérico: sem varredura com CAST/LIKE, o filtro é ignorado
+            filter_warnings.append("O ID do cliente deve ser um número inteiro válido; filtro por ID ignorado")
     
-    # Filtro por categorias
+    # Filtro por categorias (um parâmetro por valor)
     if cat_sel:
-        cat_list = ', '.join([f"'{c}'" for c in cat_sel])
-        conditions.append(f"categoria IN ({cat_list})")
+        conditions.append(_in_condition('categoria', 'cat', cat_sel, params))
     
-    # Filtro por setores
+    # Filtro por setores (um parâmetro por valor)
     if setor_sel:
-        setor_list = ', '.join([f"'{s}'" for s in setor_sel])
-        conditions.append(f"setor IN ({setor_list})")
+        conditions.append(_in_condition('setor', 'setor', setor_sel, params))
     
     # Filtro de data de visita (sempre ativo)
-    # Adiciona 1 dia ao fim para incluir todo o último dia
-    data_fim_visita_ajustada = datetime.combine(data_fim_visita, datetime.max.time())
-    conditions.append(f"data_ultima_visita >= '{data_inicio_visita}'")
-    conditions.append(f"data_ultima_visita <= '{data_fim_visita_ajustada}'")
+    # Datas ligadas como DATE; adiciona 1 dia ao fim (intervalo aberto) para incluir todo o último dia
+    conditions.append("data_ultima_visita >= $visita_inicio AND data_ultima_visita < $visita_fim")
+    params['visita_inicio'] = data_inicio_visita
+    params['visita_fim'] = data_fim_visita + timedelta(days=1)
     
     # Filtro de data de compra
     if usar_compra and data_inicio_compra and data_fim_compra:
@@ -326,15 +542,15 @@ def build_query_conditions():
         if apenas_sem_compra:
             filter_warnings.append("'Apenas sem compra' e filtro por data de compra são contraditórios")
         
-        data_fim_compra_ajustada = datetime.combine(data_fim_compra, datetime.max.time())
-        conditions.append(f"data_ultima_compra >= '{data_inicio_compra}'")
-        conditions.append(f"data_ultima_compra <= '{data_fim_compra_ajustada}'")
+        conditions.append("data_ultima_compra >= $compra_inicio AND data_ultima_compra < $compra_fim")
+        params['compra_inicio'] = data_inicio_compra
+        params['compra_fim'] = data_fim_compra + timedelta(days=1)
     
     # Filtro de data de cadastro
     if usar_cadastro and data_inicio_cadastro and data_fim_cadastro:
-        data_fim_cadastro_ajustada = datetime.combine(data_fim_cadastro, datetime.max.time())
-        conditions.append(f"data_cadastro >= '{data_inicio_cadastro}'")
-        conditions.append(f"data_cadastro <= '{data_fim_cadastro_ajustada}'")
+        conditions.append("data_cadastro >= $cadastro_inicio AND data_cadastro < $cadastro_fim")
+        params['cadastro_inicio'] = data_inicio_cadastro
+        params['cadastro_fim'] = data_fim_cadastro + timedelta(days=1)
     
     # Filtro para clientes sem compra
     if apenas_sem_compra:
@@ -369,48 +585,124 @@ def build_query_conditions():
             st.markdown(f"- {warning}")
         st.markdown('</div>', unsafe_allow_html=True)
     
-    return " AND ".join(conditions) if conditions else "1=1", filter_warnings
+    return " AND ".join(conditions) if conditions else "1=1", params, filter_warnings
+
+def _prefetch_batches(reader, depth=2):
+    """Lê os próximos lotes do DuckDB em uma thread enquanto o lote atual é gravado"""
+    fila = queue.Queue(maxsize=depth)
+    parar = threading.Event()
+    fim = object()
+    
+    def _enfileira(item):
+        # Desiste se o consumidor parou (ex.: erro na escrita), sem bloquear a thread
+        while not parar.is_set():
+            try:
+                fila.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def _produz():
+        try:
+            for batch in reader:
+                if not _enfileira(batch):
+                    return
+            _enfileira(fim)
+        except Exception as e:
+            _enfileira(e)
+    
+    produtor = threading.Thread(target=_produz, daemon=True)
+    produtor.start()
+    try:
+        while True:
+            item = fila.get()
+            if item is fim:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Para a thread e espera ela soltar o reader antes de o cursor ser fechado
+        parar.set()
+        while produtor.is_alive():
+            try:
+                fila.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        produtor.join()
+
+def _write_excel_batches(reader, sink, on_progress=None):
+    """Grava lotes Arrow em Excel com xlsxwriter em constant_memory, linha a linha"""
+    total = 0
+    workbook = xlsxwriter.Workbook(sink, {'constant_memory': True, 'remove_timezone': True})
+    worksheet = workbook.add_worksheet('Clientes')
+    worksheet.write_row(0, 0, reader.schema.names)
+    # Datas precisam de formato explícito, senão o Excel mostra o número serial
+    formato_data = workbook.add_format({'num_format': 'dd/mm/yyyy hh:mm'})
+    formatos = [formato_data if pa.types.is_temporal(field.type) else None
+                for field in reader.schema]
+    # A leitura do próximo lote no DuckDB sobrepõe a escrita das linhas deste;
+    # em caso de erro, a thread de leitura é encerrada e o workbook fechado
+    try:
+        with closing(_prefetch_batches(reader)) as batches:
+            for batch in batches:
+                for row in zip(*(column.to_pylist() for column in batch.columns)):
+                    total += 1
+                    for col, (valor, formato) in enumerate(zip(row, formatos)):
+                        worksheet.write(total, col, valor, formato)
+                if on_progress:
+                    on_progress(total)
+    finally:
+        workbook.close()
+    return total
+
+def write_batches(reader, sink, export_format, on_progress=None):
+    """Grava lotes Arrow do DuckDB em Parquet ou Excel sem materializar o resultado inteiro"""
+    if export_format == "Excel":
+        return _write_excel_batches(reader, sink, on_progress)
+    
+    total = 0
+    # Parquet colunar com ZSTD nível 1: escrita mais rápida com taxa similar
+    writer = pq.ParquetWriter(sink, reader.schema, compression='zstd', compression_level=1)
+    # Compressão/escrita de um lote sobrepõe a leitura do próximo no DuckDB;
+    # closing encerra a thread de leitura mesmo se a escrita falhar
+    with writer, closing(_prefetch_batches(reader)) as batches:
+        for batch in batches:
+            writer.write_batch(batch)
+            total += batch.num_rows
+            if on_progress:
+                on_progress(total)
+    return total
 
 # ==========================================
 # ANÁLISE AUTOMÁTICA (SEMPRE EXECUTA)
 # ==========================================
 try:
-    where_clause, warnings_list = build_query_conditions()
-    
-    # Cria nova conexão DuckDB
-    con = duckdb.connect(database=':memory:')
-    
-    # Query para obter estatísticas dos filtros aplicados
-    stats_query = f"""
-    WITH filtered AS (
-        SELECT * 
-        FROM read_parquet('{dataset_info['caminho']}')
-        WHERE {where_clause}
+    where_clause, query_params, warnings_list = build_query_conditions()
+    
+    # Cursor sobre o banco compartilhado, com a view do arquivo atual
+    con = get_connection(dataset_info['caminho'])
+    
+    # Detecta se algum filtro restringe a base além do intervalo completo de visita
+    filtros_ativos = bool(
+        'id_busca' in query_params or cat_sel or setor_sel or apenas_sem_compra
+        or filtro_funcionarios != "Todos" or apenas_premium or excluir_premium
+        or usar_compra or usar_cadastro
+        or data_inicio_visita > dataset_info['min_visita'].date()
+        or data_fim_visita < dataset_info['max_visita'].date()
     )
-    SELECT 
-        COUNT(*) as total_registros,
-        COUNT(DISTINCT member_pk) as clientes_unicos,
-        {f"COUNT(CASE WHEN flg_funcionario = 'S' THEN 1 END) as funcionarios," if dataset_info['has_flg_funcionario'] else "0 as funcionarios,"}
-        {f"COUNT(CASE WHEN flg_premium_ativo = 'S' THEN 1 END) as premium" if dataset_info['has_flg_premium'] else "0 as premium"}
-    FROM filtered
-    """
     
-    result = con.execute(stats_query).fetchone()
-    
-    if result:
-        if dataset_info['has_flg_funcionario'] and dataset_info['has_flg_premium']:
-            total_filtrado, clientes_unicos, funcionarios, premium = result
-        elif dataset_info['has_flg_funcionario']:
-            total_filtrado, clientes_unicos, funcionarios, _ = result
-            premium = 0
-        elif dataset_info['has_flg_premium']:
-            total_filtrado, clientes_unicos, _, premium = result
-            funcionarios = 0
-        else:
-            total_filtrado, clientes_unicos, _, _ = result
-            funcionarios, premium = 0, 0
+    if filtros_ativos:
+        # Estatísticas dos filtros aplicados, em cache por combinação de filtros
+        result = get_filtered_stats(dataset_info['caminho'], where_clause, query_params,
+                                    dataset_info['has_flg_funcionario'], dataset_info['has_flg_premium'])
     else:
-        total_filtrado, clientes_unicos, funcionarios, premium = 0, 0, 0, 0
+        # Sem filtros: reaproveita os totais da base, sem varrer o parquet a cada rerun
+        result = get_base_stats(dataset_info['caminho'], dataset_info['mtime'],
+                                dataset_info['has_flg_funcionario'], dataset_info['has_flg_premium'])
+    
+    total_filtrado, clientes_unicos, funcionarios, premium = result
         
 except Exception as e:
     st.error(f"❌ Erro na análise dos dados: {str(e)}")
@@ -459,58 +751,34 @@ with col2:
 # ==========================================
 # PRÉ-VISUALIZAÇÃO DOS DADOS
 # ==========================================
+# Configuração de exibição de todas as colunas conhecidas; cada render usa as presentes
+PREVIEW_COLUMN_CONFIG = {
+    "member_pk": st.column_config.TextColumn("ID Cliente", width="large"),
+    "categoria": st.column_config.TextColumn("Categoria", width="medium"),
+    "setor": st.column_config.TextColumn("Setor", width="medium"),
+    "data_ultima_visita": st.column_config.DatetimeColumn("Última Visita", format="DD/MM/YYYY HH:mm"),
+    "data_ultima_compra": st.column_config.DatetimeColumn("Última Compra", format="DD/MM/YYYY HH:mm"),
+    "data_cadastro": st.column_config.DatetimeColumn("Data Cadastro", format="DD/MM/YYYY"),
+    "flg_premium_ativo": st.column_config.TextColumn("Premium", width="small"),
+    "flg_funcionario": st.column_config.TextColumn("Funcionário", width="small"),
+}
+
 if total_filtrado > 0 and con is not None:
     with st.expander("👁️ **Pré-visualização dos Dados**", expanded=True):
         try:
-            # Define colunas para exibição
+            # Colunas básicas sempre; as opcionais só se existirem no dataset
             base_cols = ['member_pk', 'categoria', 'setor', 'data_ultima_visita', 'data_ultima_compra']
+            base_cols += [col for col in ('data_cadastro', 'flg_premium_ativo', 'flg_funcionario')
+                          if col in dataset_info['available_columns']]
             
-            # Adiciona colunas extras se disponíveis
-            if 'data_cadastro' in dataset_info['available_columns']:
-                base_cols.append('data_cadastro')
-            
-            if 'flg_premium_ativo' in dataset_info['available_columns']:
-                base_cols.append('flg_premium_ativo')
-            
-            if 'flg_funcionario' in dataset_info['available_columns']:
-                base_cols.append('flg_funcionario')
-            
-            # Prepara query de preview
-            cols_str = ', '.join(base_cols)
-            preview_query = f"""
-            SELECT {cols_str}
-            FROM read_parquet('{dataset_info['caminho']}')
-            WHERE {where_clause}
-            ORDER BY data_ultima_visita DESC
-            LIMIT 100
-            """
-            
-            preview_df = con.execute(preview_query).df()
+            # Preview em cache: só consulta o DuckDB quando os filtros mudam
+            preview_df = get_preview(dataset_info['caminho'], tuple(base_cols),
+                                     where_clause, query_params)
             
-            if not preview_df.empty:
-                # Configurações das colunas para exibição
-                column_config = {
-                    "member_pk": st.column_config.TextColumn("ID Cliente", width="large"),
-                    "categoria": st.column_config.TextColumn("Categoria", width="medium"),
-                    "setor": st.column_config.TextColumn("Setor", width="medium"),
-                    "data_ultima_visita": st.column_config.DatetimeColumn("Última Visita", format="DD/MM/YYYY HH:mm"),
-                    "data_ultima_compra": st.column_config.DatetimeColumn("Última Compra", format="DD/MM/YYYY HH:mm"),
-                }
-                
-                # Adiciona configuração para data_cadastro se existir
-                if 'data_cadastro' in preview_df.columns:
-                    column_config["data_cadastro"] = st.column_config.DatetimeColumn("Data Cadastro", format="DD/MM/YYYY")
-                
-                if 'flg_premium_ativo' in preview_df.columns:
-                    column_config["flg_premium_ativo"] = st.column_config.TextColumn("Premium", width="small")
-                
-                if 'flg_funcionario' in preview_df.columns:
-                    column_config["flg_funcionario"] = st.column_config.TextColumn("Funcionário", width="small")
-                
-                # Formatação das datas
-                date_cols = [col for col in preview_df.columns if 'data_' in col]
-                for col in date_cols:
-                    preview_df[col] = pd.to_datetime(preview_df[col], errors='coerce')
+            if preview_df.num_rows > 0:
+                # Configurações das colunas presentes na pré-visualização
+                column_config = {col: PREVIEW_COLUMN_CONFIG[col] for col in preview_df.column_names
+                                 if col in PREVIEW_COLUMN_CONFIG}
                 
                 st.dataframe(
                     preview_df,
@@ -567,10 +835,10 @@ if total_filtrado > 0 and con is not None:
         st.info(export_summary)
     
     with col_exp2:
-        export_disabled = total_filtrado > 1000000 and export_format == "Excel"
+        export_disabled = total_filtrado > EXCEL_MAX_ROWS and export_format == "Excel"
         
         if export_disabled:
-            st.warning("Excel limitado a 1M registros")
+            st.warning(f"Excel limitado a {EXCEL_MAX_ROWS:,} registros")
         else:
             if st.button("🚀 Gerar Arquivo", type="primary", use_container_width=True):
                 with st.spinner("Preparando exportação..."):
@@ -579,38 +847,48 @@ if total_filtrado > 0 and con is not None:
                         select_cols = "member_pk" if only_member_pk else "*"
                         export_query = f"""
                         SELECT {select_cols}
-                        FROM read_parquet('{dataset_info['caminho']}')
+                        FROM {dataset_view(dataset_info['caminho'])}
                         WHERE {where_clause}
                         ORDER BY data_ultima_visita DESC
                         """
                         
-                        export_df = con.execute(export_query).df()
-                        
-                        # Gera arquivo
+                        # Gera arquivo em disco: a memória guarda só um lote por vez
                         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                        file_ext, mime_type = EXPORT_FORMATS[export_format]
+                        file_name = f"clientes_{timestamp}{file_ext}"
                         
-                        if export_format == "Excel":
-                            import io
-                            buffer = io.BytesIO()
-                            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                                export_df.to_excel(writer, index=False, sheet_name='Clientes')
-                            buffer.seek(0)
-                            file_data = buffer.getvalue()
-                            file_name = f"clientes_{timestamp}.xlsx"
-                            mime_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                        else:
-                            file_data = export_df.to_csv(index=False, sep=';', encoding='utf-8').encode('utf-8')
-                            file_name = f"clientes_{timestamp}.csv"
-                            mime_type = "text/csv"
-                        
-                        # Botão de download
-                        st.download_button(
-                            label=f"📥 Baixar {export_format} ({len(export_df):,} registros)",
-                            data=file_data,
-                            file_name=file_name,
-                            mime=mime_type,
-                            use_container_width=True
-                        )
+                        with tempfile.TemporaryDirectory() as tmp_dir:
+                            tmp_path = os.path.join(tmp_dir, file_name)
+                            
+                            if export_format in ("CSV", "CSV.gz"):
+                                # CSV escrito pelo próprio DuckDB (COPY): vetorizado, paralelo e sem Python
+                                compression = "GZIP" if export_format == "CSV.gz" else "NONE"
+                                # TMPDIR pode conter aspas: escapa o literal como na view do dataset
+                                tmp_path_sql = tmp_path.replace("'", "''")
+                                copy_query = (f"COPY ({export_query}) TO '{tmp_path_sql}' "
+                                              f"(FORMAT CSV, HEADER, DELIMITER ';', COMPRESSION {compression})")
+                                total_exportado = con.execute(copy_query, query_params).fetchone()[0]
+                            else:
+                                # Streaming em lotes: um lote por vez em memória
+                                reader = con.execute(export_query, query_params).fetch_record_batch(EXPORT_BATCH_SIZE)
+                                progresso = st.progress(0.0, text="Exportando...")
+                                total_exportado = write_batches(
+                                    reader, tmp_path, export_format,
+                                    on_progress=lambda n: progresso.progress(
+                                        min(n / total_filtrado, 1.0), text=f"Exportando... {n:,} de {total_filtrado:,}")
+                                )
+                                progresso.empty()
+                            
+                            # O arquivo é lido uma única vez pelo próprio download_button;
+                            # o diretório temporário só é removido depois dessa leitura
+                            with open(tmp_path, 'rb') as file_data:
+                                st.download_button(
+                                    label=f"📥 Baixar {export_format} ({total_exportado:,} registros)",
+                                    data=file_data,
+                                    file_name=file_name,
+                                    mime=mime_type,
+                                    use_container_width=True
+                                )
                         
                         st.success("✅ Arquivo gerado com sucesso!")
                         
@@ -0,0 +1,53 @@
+import argparse
+import duckdb
+
+# ==========================================
+# OTIMIZAÇÃO DO PARQUET (PASSO ÚNICO, FORA DO APP)
+# ==========================================
+# Regrava o dataset ordenado pelas colunas de filtro, em row groups menores e
+# com ZSTD. A data da última visita vem primeiro porque o filtro de período é
+# sempre aplicado: cada row group cobre uma faixa curta de datas e o DuckDB pula
+# os que ficam fora do período pelas estatísticas min/max.
+# Troca consciente: categoria/setor são só desempate dentro de cada data, então
+# um filtro só de categoria quase não pula row groups. Particionar por categoria
+# (pastas Hive) resolveria isso, mas o app baixa e lê um único dataset.parquet
+# (footer, estatísticas, dicionários); por isso a data, filtro sempre ativo, vence.
+# O arquivo gerado deve ser publicado no Hugging Face como dataset.parquet.
+
+ORDEM = "data_ultima_visita, categoria, setor"
+ROW_GROUP_SIZE = 100_000
+
+
+def otimizar(entrada, saida):
+    """Regrava o parquet ordenado, com row groups de tamanho fixo e compressão ZSTD"""
+    # Caminhos vêm da linha de comando: aspas simples escapadas nos literais SQL
+    entrada_sql = entrada.replace("'", "''")
+    saida_sql = saida.replace("'", "''")
+    con = duckdb.connect(database=':memory:')
+    con.execute(f"""
+    COPY (
+        SELECT *
+        FROM read_parquet('{entrada_sql}')
+        ORDER BY {ORDEM}
+    ) TO '{saida_sql}' (FORMAT PARQUET, ROW_GROUP_SIZE {ROW_GROUP_SIZE}, COMPRESSION ZSTD)
+    """)
+    faixas = con.execute(f"""
+    SELECT row_group_id, stats_min, stats_max
+    FROM parquet_metadata('{saida_sql}')
+    WHERE path_in_schema = 'data_ultima_visita'
+    ORDER BY row_group_id
+    """).fetchall()
+    con.close()
+    return faixas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Otimiza o dataset de clientes para filtros")
+    parser.add_argument("entrada", help="Parquet original")
+    parser.add_argument("saida", help="Parquet otimizado a publicar como dataset.parquet")
+    args = parser.parse_args()
+
+    faixas = otimizar(args.entrada, args.saida)
+    print(f"✅ {args.saida} gerado com {len(faixas)} row groups")
+    for row_group, minimo, maximo in faixas:
+        print(f"   row group {row_group}: data_ultima_visita de {minimo} a {maximo}")